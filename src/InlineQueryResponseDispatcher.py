@@ -1,10 +1,12 @@
-from threading import Thread, Lock
-from multiprocessing import Process
+from contextlib import nullcontext
+from threading import BoundedSemaphore, Thread, Lock
+from multiprocessing import Process, Pipe
+from multiprocessing.connection import Connection, wait
 from telegram import (
     Bot, InlineQuery, InlineQueryResultCachedVideo, TelegramError,
     InlineQueryResultArticle, InputTextMessageContent, Message
 )
-from telegram.error import NetworkError
+from telegram.error import NetworkError, BadRequest
 import logging
 import signal
 from typing import Optional
@@ -12,14 +14,32 @@ from yt_dlp.utils import YoutubeDLError
 from dataclasses import dataclass
 
 from resourcemanager import resource_manager
+from tracing import tracer, new_request_id
+from negative_cache import negative_cache, classify_error
+from bot_request import BotApiClient, serve_bot_api_call
 
 from util import validate_query, clean_yt_error
-from downloader import VideoInfo, Downloader
+from downloader import VideoInfo, Downloader, DownloadInterrupted
+from upload_index import upload_index, UploadEntry, PendingEntry, is_file_id_error
+from staging import staging_area
+from settings import config
+from url_cleaner import get_canonical_url
 
 
 @dataclass
 class Query:
+    query: str
     process: Optional[Process] = None
+    # terminated by a newer query of the user
+    cancelled: bool = False
+
+
+def download_error_result(query: str, error: str) -> InlineQueryResultArticle:
+    return InlineQueryResultArticle(
+        0, resource_manager.get_string("error_inline_download_title"),
+        InputTextMessageContent(f"Error downloading: {query}"),
+        description=error
+    )
 
 
 class InlineQueryRespondDispatcher:
@@ -32,9 +52,17 @@ class InlineQueryRespondDispatcher:
         self._next_query_lock = Lock()
         self._next_query_arrived_events = {}
 
+        # calls of the children share the pool with the workers and the polling,
+        # this keeps them to their share of it
+        self._api_slots = BoundedSemaphore(config.inline_api_connections)
+        self._upload_slots = BoundedSemaphore(
+            min(config.inline_uploads, config.inline_api_connections)
+        )
+
     def dispatchInlineQueryResponse(self, inline_query: InlineQuery):
         logging.debug(f"Received inline query {inline_query}")
 
+        previous = None
         with self._next_query_lock:
             try:
                 query = self._next_query_arrived_events[inline_query.from_user.id]
@@ -42,46 +70,133 @@ class InlineQueryRespondDispatcher:
                 # way to stop YoutubeDL during the download
                 if query.process is not None:
                     query.process.terminate()
+                    query.cancelled = True
+                    previous = query
             except KeyError:
                 ...
             finally:
-                new_query = Query()
+                new_query = Query(inline_query.query)
                 self._next_query_arrived_events[inline_query.from_user.id] = new_query
 
-        responder = InlineQueryResponse(inline_query, self.bot, self.devnullchat)
+        request_id = new_request_id()
+        if (cached_error := negative_cache.get(inline_query.query)) is not None:
+            logging.debug(f"[{request_id}] Answering inline query '{inline_query.query}' from cache")
+            with tracer.span(request_id, "inline_query", outcome="negative_cached"):
+                self.bot.answerInlineQuery(
+                    inline_query.id, [download_error_result(inline_query.query, cached_error)],
+                    cache_time=0
+                )
+            return
+
+        if (
+            previous is not None and staging_area.enabled
+            and get_canonical_url(previous.query) == get_canonical_url(inline_query.query)
+        ):
+            # give the cancelled download of the same video the chance to stage
+            # its files. Waiting on the sentinel doesn't reap the process, that
+            # is left to `joinProcess`
+            wait([previous.process.sentinel], config.staging_handover_timeout_s)
+
+        connection, child_connection = Pipe()
+        responder = InlineQueryResponse(
+            inline_query, self.devnullchat, request_id, child_connection
+        )
         process = Process(target=responder.start_process)
-        self._next_query_arrived_events[inline_query.from_user.id].process = process
-        process.start()
-        Thread(target=self.joinProcess, args=[process, inline_query.query]).start()
+        with self._next_query_lock:
+            # a newer query of the user might have arrived during the wait
+            if self._next_query_arrived_events.get(inline_query.from_user.id) is not new_query:
+                logging.debug(f"[{request_id}] Inline query '{inline_query.query}' was superseded")
+                connection.close()
+                child_connection.close()
+                return
 
-    def joinProcess(self, process, query):
-        logging.debug(f"Starting process - '{query}' {process}")
+            # started under the lock, so a newer query can always terminate it
+            process.start()
+            new_query.process = process
+        child_connection.close()
+        Thread(target=self.joinProcess, args=[new_query, request_id, connection]).start()
+
+    def joinProcess(self, query: Query, request_id, connection: Connection):
+        process = query.process
+        logging.debug(f"[{request_id}] Starting process - '{query.query}' {process}")
+        try:
+            self._serve_child(query, connection)
+        finally:
+            connection.close()
         process.join()
-        logging.debug(f"Ending process - {process}")
+        logging.debug(f"[{request_id}] Ending process - {process}")
+
+    def _serve_child(self, query: Query, connection: Connection):
+        """Handle the messages of a child until it exits"""
+        while connection in wait([connection, query.process.sentinel]):
+            try:
+                message = connection.recv()
+            except (EOFError, OSError):
+                # child closed the pipe or was terminated while writing
+                return
+            self._handle_message(query, connection, *message)
+
+    def _handle_message(self, query: Query, connection: Connection, kind: str, *args):
+        if kind == "bot_api":
+            self._serve_bot_api_call(query, connection, *args)
+        # results of a child process that should outlive it
+        elif kind == "negative_result":
+            negative_cache.put(*args)
+        elif kind == "upload":
+            upload_index.put(*args)
+        elif kind == "upload_saved":
+            upload_index.add_saved(*args)
+        elif kind == "upload_stale":
+            upload_index.remove(*args)
+
+    def _serve_bot_api_call(
+        self, query: Query, connection: Connection, call_id: int, method: str, *args
+    ):
+        upload_slot = self._upload_slots if method == "send_video" else nullcontext()
+        with upload_slot, self._api_slots:
+            # an upload can't be aborted once it runs here, so none is started for
+            # a cancelled query. Deletes are still needed to clean up after it
+            if method != "delete_message" and (query.cancelled or not query.process.is_alive()):
+                logging.debug(f"Skipping {method} of cancelled inline query '{query.query}'")
+                try:
+                    # yt-dlp can swallow the SIGTERM, so the child might still wait
+                    connection.send((call_id, False, TelegramError("Inline query was cancelled")))
+                except OSError:
+                    ...
+                return
+            serve_bot_api_call(self.bot, connection, call_id, method, *args)
 
 
-class StopProcessException(Exception):
+class StopProcessException(DownloadInterrupted):
     ...
 
 
 class InlineQueryResponse:
     def __init__(
-        self, inline_query: InlineQuery, bot: Bot, devnullchat: int
+        self, inline_query: InlineQuery, devnullchat: int, request_id: str,
+        connection: Connection
     ):
         self.inline_query = inline_query
-        self._bot = bot
+        self.request_id = request_id
+        self._connection = connection
+        self._bot_api = BotApiClient(connection)
         self._devnullchat = devnullchat
 
         self.video_cache = None
+        self._deduplicated: Optional[UploadEntry] = None
+        self._pending: Optional[PendingEntry] = None
+        self._answer_attempted = False
 
     def _handle_sigterm(self, signum, frame):
-        logging.debug(f"Forcing inline response to close due to {signum} | {self}")
+        logging.debug(f"[{self.request_id}] Forcing inline response to close due to {signum}")
         raise StopProcessException()
 
     def start_process(self, *args, **kwargs):
         signal.signal(signal.SIGTERM, self._handle_sigterm)
         try:
-            self.respondToInlineQuery(*args, **kwargs)
+            with tracer.profile(self.request_id, "inline_query"), \
+                    tracer.span(self.request_id, "inline_query"):
+                self.respondToInlineQuery(*args, **kwargs)
         except TypeError as err:
             if str(err) != "handler() has 0 arguments but 2 where given":
                 raise err
@@ -99,45 +214,86 @@ class InlineQueryResponse:
 
         result = None
         try:
-            with Downloader() as downloader:
+            with Downloader(request_id=self.request_id) as downloader:
                 info = downloader.start(query)
-                self.video_cache = self._upload_video(info)
+                media_id = self._get_media_id(info)
 
-            if self.video_cache is not None:
-                media_id = self.video_cache.video.file_id
-                result = InlineQueryResultCachedVideo(
-                    0, video_file_id=media_id, title=info.title, caption=info.url
-                )
+                # answered while the file exists, a stale file_id needs a new upload
+                if media_id is not None:
+                    self._answer_video(query_id, media_id, info)
         except TelegramError as err:
-            logging.warn("Error handling inline query", exc_info=err)
+            logging.warn(f"[{self.request_id}] Error handling inline query", exc_info=err)
             result = InlineQueryResultArticle(
                 0, resource_manager.get_string("error_inline_telegram_title"),
                 InputTextMessageContent(err.message), description=str(err)
             )
         except YoutubeDLError as err:
-            result = InlineQueryResultArticle(
-                0, resource_manager.get_string("error_inline_download_title"),
-                InputTextMessageContent(f"Error downloading: {query}"),
-                description=clean_yt_error(err)
-            )
+            self._connection.send(("negative_result", query, classify_error(err), clean_yt_error(err)))
+            result = download_error_result(query, clean_yt_error(err))
         finally:
-            if result is not None:
-                self._bot.answerInlineQuery(query_id, [result], cache_time=0)
-                logging.debug(f"Answered to inline query '{query}'")
+            # after a failed answer (e.g. the query is too old) another one fails too
+            if result is not None and not self._answer_attempted:
+                self._answer(query_id, result)
+
+    def _answer(self, query_id: str, result):
+        self._answer_attempted = True
+        self._bot_api.answer_inline_query(query_id, [result], cache_time=0)
+        logging.debug(f"[{self.request_id}] Answered to inline query '{self.inline_query.query}'")
+
+    def _answer_video(self, query_id: str, media_id: str, info: VideoInfo):
+        def video_result(file_id: str) -> InlineQueryResultCachedVideo:
+            return InlineQueryResultCachedVideo(0, video_file_id=file_id, title=info.title, caption=info.url)
+
+        try:
+            self._answer(query_id, video_result(media_id))
+        except BadRequest as err:
+            if self._deduplicated is None or not is_file_id_error(err):
+                raise
+
+            logging.info(f"[{self.request_id}] Stale file_id, uploading again ({err.message})")
+            self._connection.send(("upload_stale", self._deduplicated.file_id))
+            self._deduplicated = None
+
+            if (media_id := self._upload(info)) is None:
+                return
+            self._answer(query_id, video_result(media_id))
+
+        if self._deduplicated is not None:
+            upload_index.record_saved(self.request_id, self._deduplicated.size)
+            self._connection.send(("upload_saved", self._deduplicated.size))
+        elif self._pending is not None and (new_entry := self._pending.entry(media_id)):
+            # the hash only has to be done for the next query, not for this answer
+            self._connection.send(("upload", *new_entry))
 
     def _close_down(self):
-        logging.debug("Cleaning up query {self}")
+        logging.debug(f"[{self.request_id}] Cleaning up query '{self.inline_query.query}'")
         if self.video_cache is not None:
-            self.video_cache.delete()
+            self._bot_api.delete_message(self.video_cache.chat_id, self.video_cache.message_id)
             self.video_cache = None
+        self._connection.close()
+
+    def _get_media_id(self, info: VideoInfo) -> Optional[str]:
+        """Reuse the file_id of an earlier upload with the same content if possible"""
+        if (entry := upload_index.get(info.filepath)) is not None:
+            self._deduplicated = entry
+            return entry.file_id
+        return self._upload(info)
+
+    def _upload(self, info: VideoInfo) -> Optional[str]:
+        self._pending = PendingEntry(info.filepath)
+        self.video_cache = self._upload_video(info)
+        if self.video_cache is None or self.video_cache.video is None:
+            return None
+        return self.video_cache.video.file_id
 
     def _upload_video(self, info: VideoInfo) -> Message:
         try:
-            v_msg = self._bot.send_video(
-                self._devnullchat, open(info.filepath, "rb"),
-                filename=info.orig_filename
-            )
-            logging.debug(f"Video {info.orig_filename} uploaded successfully")
+            with tracer.span(self.request_id, "upload") as span:
+                span.bytes = info.filepath.stat().st_size
+                v_msg = self._bot_api.send_video(
+                    self._devnullchat, info.filepath, filename=info.orig_filename
+                )
+            logging.debug(f"[{self.request_id}] Video {info.orig_filename} uploaded successfully")
             return v_msg
         except TelegramError as err:
-            logging.warn(f"Telegram Error occured: {err}")
+            logging.warn(f"[{self.request_id}] Telegram Error occured: {err}")
@@ -1,23 +1,46 @@
 import logging
-from typing import Callable, Dict
+from threading import Thread
+from typing import Any, Callable, Dict, Optional
 from telegram import Update, TelegramError, Message, MessageEntity
+from telegram.error import BadRequest
 import tempfile
 from telegram.utils.helpers import escape_markdown
 from telegram.ext import (
     Updater, Dispatcher, CallbackContext, CommandHandler, 
-    Filters, InlineQueryHandler, MessageHandler
+    Filters, InlineQueryHandler, MessageHandler, TypeHandler
 )
 
 from yt_dlp.utils import YoutubeDLError
-from downloader import Downloader 
+from downloader import Downloader, VideoInfo
 from resourcemanager import resource_manager
 from InlineQueryResponseDispatcher import InlineQueryRespondDispatcher
 from util import clean_yt_error
+from tracing import Span, tracer, new_request_id
+from traffic import TrafficRecorder
+from negative_cache import negative_cache, classify_error
+from settings import config
+from bot_request import create_bot, pool_stats
+from upload_index import upload_index, is_file_id_error, PendingEntry
 
 
 class InlineBot:
-    def __init__(self, token, devnullchat=-1):
-        self._updater = Updater(token=token, use_context=True)
+    def __init__(self, token, devnullchat=-1, base_url: Optional[str] = None):
+        if base_url is None:
+            base_url = config.bot_api_base_url
+        # every worker, the polling, the dispatcher thread and the calls forwarded
+        # from inline children can need a connection at the same time
+        con_pool_size = config.bot_workers + 2 + config.inline_api_connections
+        self._updater = Updater(
+            bot=create_bot(token, base_url, con_pool_size, config.bot_api_pool_timeout_s),
+            workers=config.bot_workers, use_context=True
+        )
+
+        if config.traffic_capture_file is not None:
+            recorder = TrafficRecorder(config.traffic_capture_file)
+            # group -1 runs before and independent of the handlers below
+            self._dispatcher.add_handler(
+                TypeHandler(Update, lambda update, _: recorder.record(update)), group=-1
+            )
 
         self._inline_query_response_dispatcher = InlineQueryRespondDispatcher(
             self._updater.bot, devnullchat
@@ -51,11 +74,20 @@ class InlineBot:
     def _dispatcher(self) -> Dispatcher:
         return self._updater.dispatcher
 
-    def launch(self):
-        self._updater.start_polling()
+    def launch(self, polling: bool = True):
+        if polling:
+            self._updater.start_polling()
+        else:
+            # only handle updates passed to `process_update`
+            Thread(target=self._dispatcher.start, name="dispatcher").start()
+
+    def process_update(self, data: Dict[str, Any]):
+        self._dispatcher.update_queue.put(Update.de_json(data, self._dispatcher.bot))
 
     def stop(self):
         self._updater.stop()
+        logging.info(f"Bot API connection pool: {pool_stats}")
+        logging.info(f"Skipped {upload_index.bytes_saved} bytes of duplicate uploads")
 
     def on_start(self, update: Update, context: CallbackContext):
         update.message.reply_text(resource_manager.get_string("greeting"))
@@ -96,6 +128,13 @@ class InlineBot:
         return handler
 
     def on_download(self, update: Update, context: CallbackContext):
+        request_id = new_request_id()
+        with tracer.profile(request_id, "download_command"), \
+                tracer.span(request_id, "download_command") as span:
+            self._download(update, context, span)
+
+    def _download(self, update: Update, context: CallbackContext, span: Span):
+        request_id = span.request_id
         url = None
         status_message = None
 
@@ -116,41 +155,77 @@ class InlineBot:
             update.message.reply_text(resource_manager.get_string("download_error_arg_one"))
             return
 
+        if (cached_error := negative_cache.get(url)) is not None:
+            logging.info(f"[{request_id}] Cached download error ({url})")
+            span.outcome = "negative_cached"
+            self._reply_download_error(update, cached_error)
+            return
+
         try:
             status_message = update.message.reply_text(
                 resource_manager.get_string("status_download_progress", progress="0"),
                 parse_mode="Markdown", reply_to_message_id=update.message.message_id
             )
 
-            with Downloader() as downloader:
+            with Downloader(request_id=request_id) as downloader:
                 info = downloader.start(
                     url, self._build_progress_handler(status_message)
                 )
 
-                logging.debug(f"Bot: Uploading file '{info.orig_filename}'")
-                update.message.reply_video(
-                    open(info.filepath, "rb"),
-                    supports_streaming=True, reply_to_message_id=update.message.message_id,
-                    filename=info.orig_filename, duration=info.duration_s
-                )
+                self._reply_video(update, info, request_id)
         except TelegramError as err:
-            logging.warn("Telegram error", exc_info=err)
+            logging.warn(f"[{request_id}] Telegram error", exc_info=err)
             update.message.reply_markdown(
                 resource_manager.get_string("error_telegram", error=err.message),
                 reply_to_message_id=update.message.message_id
             )
         except YoutubeDLError as err:
-            logging.info(f"Download error ({url})")
-            error_text = escape_markdown(clean_yt_error(err), version=2, entity_type="CODE")
-            update.message.reply_markdown_v2(
-                resource_manager.get_string("error_download", error=error_text),
-                reply_to_message_id=update.message.message_id,
-                disable_web_page_preview=True
-            )
+            logging.info(f"[{request_id}] Download error ({url})")
+            negative_cache.put(url, classify_error(err), clean_yt_error(err))
+            self._reply_download_error(update, clean_yt_error(err))
         finally:
             if status_message is not None:
                 status_message.delete()
 
+    def _reply_video(self, update: Update, info: VideoInfo, request_id: str):
+        if (entry := upload_index.get(info.filepath)) is not None:
+            try:
+                with tracer.span(request_id, "upload", outcome="deduplicated"):
+                    update.message.reply_video(
+                        entry.file_id,
+                        supports_streaming=True, reply_to_message_id=update.message.message_id,
+                        duration=info.duration_s
+                    )
+                upload_index.record_saved(request_id, entry.size)
+                return
+            except BadRequest as err:
+                if not is_file_id_error(err):
+                    raise
+                logging.info(f"[{request_id}] Stale file_id, uploading again ({err.message})")
+                upload_index.remove(entry.file_id)
+
+        logging.debug(f"[{request_id}] Bot: Uploading file '{info.orig_filename}'")
+        pending = PendingEntry(info.filepath)
+        with tracer.span(request_id, "upload") as span:
+            span.bytes = info.filepath.stat().st_size
+            message = update.message.reply_video(
+                open(info.filepath, "rb"),
+                supports_streaming=True, reply_to_message_id=update.message.message_id,
+                filename=info.orig_filename, duration=info.duration_s
+            )
+
+        # telegram might have turned it into an animation or document
+        if message.video is not None and (new_entry := pending.entry(message.video.file_id)):
+            upload_index.put(*new_entry)
+
+    def _reply_download_error(self, update: Update, error: str):
+        error_text = escape_markdown(error, version=2, entity_type="CODE")
+        update.message.reply_markdown_v2(
+            resource_manager.get_string("error_download", error=error_text),
+            reply_to_message_id=update.message.message_id,
+            disable_web_page_preview=True
+        )
+
     def on_inline(self, update: Update, context: CallbackContext):
         query = update.inline_query.query
 
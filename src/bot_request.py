@@ -0,0 +1,167 @@
+from itertools import count
+import copyreg
+from multiprocessing.connection import Connection
+from pathlib import Path
+from threading import Lock
+from time import monotonic
+from typing import Any, Dict, List, Tuple
+import logging
+import os
+
+from telegram import Bot, Message, TelegramError, TelegramObject
+from telegram.utils.helpers import DefaultValue, DEFAULT_NONE, DEFAULT_FALSE, DEFAULT_20
+from telegram.utils.request import Request, urllib3
+
+from tracing import tracer
+
+
+class PoolStats:
+    """Time spent waiting for a free connection to the Bot API"""
+    # waits below this are the normal fast path and not traced individually
+    TRACE_THRESHOLD_S = 0.001
+
+    def __init__(self):
+        self._lock = Lock()
+        self.count = 0
+        self.total_wait_s = 0.0
+        self.max_wait_s = 0.0
+
+    def record(self, wait_s: float):
+        with self._lock:
+            self.count += 1
+            self.total_wait_s += wait_s
+            self.max_wait_s = max(self.max_wait_s, wait_s)
+
+        if wait_s >= self.TRACE_THRESHOLD_S:
+            tracer.write({
+                "kind": "metric", "name": "bot_api_pool_wait_s", "value": wait_s, "pid": os.getpid()
+            })
+
+    def __str__(self) -> str:
+        mean = self.total_wait_s / self.count if self.count > 0 else 0
+        return (
+            f"{self.count} requests waited {mean * 1000:.1f}ms on average "
+            f"and {self.max_wait_s * 1000:.1f}ms at most"
+        )
+
+
+pool_stats = PoolStats()
+
+
+def _timed_pool(pool_class, pool_timeout_s: float):
+    class TimedPool(pool_class):
+        def _get_conn(self, timeout=None):
+            start = monotonic()
+            try:
+                return super()._get_conn(pool_timeout_s if timeout is None else timeout)
+            except urllib3.exceptions.EmptyPoolError:
+                # PTB turns this into a NetworkError for the caller
+                logging.warning(
+                    f"No Bot API connection free after {pool_timeout_s}s "
+                    f"(pool size {self.pool.maxsize})"
+                )
+                raise
+            finally:
+                pool_stats.record(monotonic() - start)
+
+    return TimedPool
+
+
+class PooledRequest(Request):
+    """
+    Keep-alive connection pool for the Bot API. Requests wait up to
+    `pool_timeout_s` for a free connection instead of opening one that is
+    thrown away afterwards.
+    """
+    def __init__(self, con_pool_size: int, pool_timeout_s: float, **kwargs):
+        super().__init__(con_pool_size=con_pool_size, **kwargs)
+
+        manager = self._con_pool
+        if isinstance(manager, urllib3.PoolManager):
+            manager.connection_pool_kw["block"] = True
+            manager.pool_classes_by_scheme = {
+                "http": _timed_pool(urllib3.HTTPConnectionPool, pool_timeout_s),
+                "https": _timed_pool(urllib3.HTTPSConnectionPool, pool_timeout_s),
+            }
+
+
+def create_bot(token: str, base_url: str, con_pool_size: int, pool_timeout_s: float) -> Bot:
+    return Bot(token, base_url=base_url, request=PooledRequest(con_pool_size, pool_timeout_s))
+
+
+def _restore_default_value(value: Any) -> DefaultValue:
+    for default in [DEFAULT_NONE, DEFAULT_FALSE, DEFAULT_20]:
+        if type(default.value) is type(value) and default.value == value:
+            return default
+    return DefaultValue(value)
+
+
+# PTB checks its defaults by identity (`is DEFAULT_NONE`), which pickling
+# between the inline children and the main process would break otherwise
+copyreg.pickle(DefaultValue, lambda default: (_restore_default_value, (default.value,)))
+
+
+class BotApiClient:
+    """
+    Bot API for the inline children. Calls are executed by the main process
+    with its warm connection pool, so a child opens no connections itself.
+    Files are passed as `Path` and opened by the main process.
+    """
+    def __init__(self, connection: Connection):
+        self._connection = connection
+        self._call_ids = count()
+
+    def _call(self, method: str, *args, **kwargs) -> Any:
+        call_id = next(self._call_ids)
+        self._connection.send(("bot_api", call_id, method, args, kwargs))
+
+        # skip replies to calls that were interrupted by SIGTERM
+        while (reply := self._connection.recv())[0] != call_id:
+            ...
+
+        _, ok, result = reply
+        if not ok:
+            raise result
+        return result
+
+    def send_video(self, chat_id: int, video: Path, **kwargs) -> Message:
+        return Message.de_json(self._call("send_video", chat_id, video, **kwargs), None)
+
+    def answer_inline_query(self, inline_query_id: str, results: List, **kwargs) -> bool:
+        return self._call("answer_inline_query", inline_query_id, results, **kwargs)
+
+    def delete_message(self, chat_id: int, message_id: int) -> bool:
+        return self._call("delete_message", chat_id, message_id)
+
+
+def serve_bot_api_call(
+    bot: Bot, connection: Connection, call_id: int, method: str,
+    args: Tuple, kwargs: Dict[str, Any]
+):
+    """Execute a call of a `BotApiClient` in the main process and send back the result"""
+    assert method in ["send_video", "answer_inline_query", "delete_message"], method
+
+    files = {i: open(a, "rb") for i, a in enumerate(args) if isinstance(a, Path)}
+    result = None
+    try:
+        result = getattr(bot, method)(*[files.get(i, a) for i, a in enumerate(args)], **kwargs)
+        reply = (call_id, True, result.to_dict() if isinstance(result, TelegramObject) else result)
+    except TelegramError as err:
+        reply = (call_id, False, err)
+    except Exception as err:
+        # the child has to get an answer in any case, otherwise it waits forever
+        logging.error(f"Bot API call {method} of inline child failed", exc_info=err)
+        reply = (call_id, False, TelegramError(str(err)))
+    finally:
+        for f in files.values():
+            f.close()
+
+    try:
+        connection.send(reply)
+    except OSError:
+        # the child was terminated during the call and can't clean up after it
+        if isinstance(result, Message):
+            try:
+                result.delete()
+            except TelegramError as err:
+                logging.warning(f"Could not delete orphaned message: {err}")
@@ -14,6 +14,8 @@ from settings import config
 from resourcemanager import resource_manager 
 from util import generate_token
 from url_cleaner import get_cleaned_url
+from tracing import tracer, new_request_id, Span
+from staging import staging_area
 
 
 @dataclass
@@ -35,6 +37,17 @@ class VideoInfo:
         return f"{self.title}.{self.ext}"
 
 
+class DownloadInterrupted(Exception):
+    """Raised into a running download to stop it, its partial files are staged"""
+
+
+class VideoRejectedError(DownloadError):
+    """Raised by the match filter, `reason` names the filter which rejected the video"""
+    def __init__(self, msg: str, reason: str, url: str = ""):
+        super().__init__(msg, UnsupportedError(url))
+        self.reason = reason
+
+
 class MyLogger:
     def debug(self, msg):
         if msg.startswith('[debug] '):
@@ -62,29 +75,57 @@ class MyLogger:
 
 
 class Downloader:
-    def __init__(self, temp_dir: Optional[tempfile.TemporaryDirectory] = None):
+    def __init__(
+        self, temp_dir: Optional[tempfile.TemporaryDirectory] = None,
+        request_id: Optional[str] = None
+    ):
+        self.request_id = request_id if request_id is not None else new_request_id()
+        self._postprocessor_starts: Dict[str, float] = {}
+
         self._temp_dir: tempfile.TemporaryDirectory = None
         if temp_dir is not None:
             self._init_temp_dir(temp_dir)
 
+        # only set for downloads that can be resumed from the staging area
+        self._staged_url: Optional[str] = None
+        self._work_dir: Optional[Path] = None
+
     def _init_temp_dir(self, temp_dir):
         self._temp_dir = temp_dir
-        logging.debug(f"Using temporary dictionary {self._temp_dir.name}")
+        logging.debug(f"[{self.request_id}] Using temporary dictionary {self._temp_dir.name}")
 
     def __enter__(self):
         if self._temp_dir is None:
-            self._init_temp_dir(tempfile.TemporaryDirectory())
+            if staging_area.enabled:
+                self._init_temp_dir(staging_area.temp_dir())
+            else:
+                self._init_temp_dir(tempfile.TemporaryDirectory())
         return self
 
     def __exit__(self, exc, value, tb):
+        if exc is not None and issubclass(exc, DownloadInterrupted) and self._staged_url is not None:
+            staging_area.stash(self._staged_url, self._work_dir)
         self._temp_dir.cleanup()
 
+    def _init_work_dir(self, url: str):
+        """Resume from the staging area if possible, otherwise use the temporary directory"""
+        if not staging_area.enabled:
+            self._work_dir = Path(self._temp_dir.name)
+            return
+
+        self._staged_url = url
+        self._work_dir = Path(self._temp_dir.name) / "staged"
+        if staging_area.claim(url, self._work_dir):
+            logging.debug(f"[{self.request_id}] Resuming staged download of {url}")
+        else:
+            self._work_dir.mkdir()
+
     def _get_opts(self, filename, url: str) -> Dict[str, Any]:
         return {
             "format_sort": ["res:480"],
             "outtmpl": f"{filename}.%(ext)s",
             "paths": {
-                "home": self._temp_dir.name
+                "home": str(self._work_dir)
             },
             "match_filter": self._video_filter,
             "noplaylist": True,
@@ -100,19 +141,22 @@ class Downloader:
 
     def _get_temp_file_name(self) -> Tuple[str, str]:
         uuid = generate_token(16)
-        return str(Path(self._temp_dir.name) / uuid), uuid
+        # a staged download has to find its partial files again
+        name = "media" if self._staged_url is not None else uuid
+        return str(self._work_dir / name), uuid
 
     def _video_filter(self, info_dict, *args, **kwargs):
         results = list(
-            filter(lambda v: v is not None,
-                   map(lambda f: f(info_dict), [
-                       self._filter_is_live,
-                       self._filter_length
+            filter(lambda v: v[1] is not None,
+                   map(lambda f: (f[0], f[1](info_dict)), [
+                       ("is_live", self._filter_is_live),
+                       ("too_long", self._filter_length)
                    ])
         ))
 
         if len(results) > 0:
-            raise DownloadError(results[0], UnsupportedError(info_dict.get("original_url", "")))
+            reason, msg = results[0]
+            raise VideoRejectedError(msg, reason, info_dict.get("original_url", ""))
         return None
 
     def _filter_length(self, info_dict, *args, **kwargs):
@@ -130,7 +174,21 @@ class Downloader:
 
     def _finished_hook(self, info):
         if info["status"] == "finished":
-            logging.debug(f"Downloaded file: {info['filename']}")
+            logging.debug(f"[{self.request_id}] Downloaded file: {info['filename']}")
+
+    def _postprocessor_hook(self, data):
+        """Record a span for each postprocessor (e.g. the ffmpeg remux) run"""
+        name = data["postprocessor"]
+        if data["status"] == "started":
+            self._postprocessor_starts[name] = time()
+        elif data["status"] == "finished" and name in self._postprocessor_starts:
+            self._write_postprocessor_span(name, "ok")
+
+    def _write_postprocessor_span(self, name: str, outcome: str):
+        tracer.write_span(Span(
+            self.request_id, f"postprocess.{name}",
+            start=self._postprocessor_starts.pop(name), end=time(), outcome=outcome
+        ))
 
     def _get_info_with_download(self, ydl: YoutubeDL, url: str) -> Dict[str, Any]:
         extra_info = {}
@@ -154,6 +212,7 @@ class Downloader:
 
         ydl.add_post_processor(FFmpegVideoRemuxerPP(ydl, "mp4"))
         ydl.add_progress_hook(self._finished_hook)
+        ydl.add_postprocessor_hook(self._postprocessor_hook)
         info = self._get_info_with_download(ydl, url)
         info['ext'] = "mp4"
 
@@ -173,14 +232,24 @@ class Downloader:
         return vinfo
 
     def start(self, url: str, progress_handler: Optional[Callable[[Dict], None]] = None) -> VideoInfo:
+        self._init_work_dir(url)
         filename, token = self._get_temp_file_name()
-        logging.debug(f"Download: Writing to '{filename}'")
-
-        with YoutubeDL2(self._get_opts(filename, url)) as ydl:
-            if progress_handler is not None:
-                ydl.add_progress_hook(progress_handler)
-
-            return self._start_download(url, filename, token, ydl)
+        logging.debug(f"[{self.request_id}] Download: Writing to '{filename}'")
+
+        with tracer.span(self.request_id, "download") as span:
+            try:
+                with YoutubeDL2(self._get_opts(filename, url)) as ydl:
+                    if progress_handler is not None:
+                        ydl.add_progress_hook(progress_handler)
+
+                    vinfo = self._start_download(url, filename, token, ydl)
+            finally:
+                # postprocessors that never reported back were aborted
+                for name in list(self._postprocessor_starts):
+                    self._write_postprocessor_span(name, "aborted")
+
+            span.bytes = vinfo.filepath.stat().st_size
+            return vinfo
 
     @staticmethod
     def _get_main_filepath(info: Dict[str, Any]) -> Optional[Path]:
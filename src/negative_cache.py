@@ -0,0 +1,79 @@
+from collections import OrderedDict
+from threading import Lock
+from time import monotonic
+from typing import Dict, Optional, Tuple
+import logging
+
+from yt_dlp.networking.exceptions import network_exceptions
+from yt_dlp.utils import DownloadError, UnsupportedError, YoutubeDLError
+
+from downloader import VideoRejectedError
+from settings import config
+from url_cleaner import get_canonical_url
+
+
+def classify_error(err: YoutubeDLError) -> str:
+    """Map a download error onto one of the error classes in `negative_cache_ttls_s`"""
+    if isinstance(err, VideoRejectedError):
+        return err.reason
+
+    cause = err
+    if isinstance(err, DownloadError) and err.exc_info is not None:
+        cause = err.exc_info[1]
+
+    # walk down the chain of causes, e.g. ExtractorError -> TransportError
+    while cause is not None:
+        if isinstance(cause, UnsupportedError):
+            return "unsupported"
+        if isinstance(cause, network_exceptions + (OSError,)):
+            return "network"
+        if "private" in str(cause).lower():
+            return "private"
+        cause = getattr(cause, "cause", None) or cause.__cause__
+
+    return "other"
+
+
+class NegativeCache:
+    """
+    Bounded LRU cache of failed downloads keyed by the canonical URL. Entries
+    expire after a TTL that depends on the class of the error.
+    """
+    def __init__(self, max_size: int, ttls_s: Dict[str, float]):
+        self.max_size = max_size
+        self.ttls_s = ttls_s
+
+        self._lock = Lock()
+        self._entries: "OrderedDict[str, Tuple[float, str]]" = OrderedDict()
+
+    def get(self, url: str) -> Optional[str]:
+        """Returns the cached error message for the URL if there is one"""
+        key = get_canonical_url(url)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+
+            expires, message = entry
+            if expires < monotonic():
+                del self._entries[key]
+                return None
+
+            self._entries.move_to_end(key)
+            return message
+
+    def put(self, url: str, error_class: str, message: str):
+        ttl = self.ttls_s.get(error_class, self.ttls_s.get("other", 0))
+        if ttl <= 0:
+            return
+
+        key = get_canonical_url(url)
+        logging.debug(f"Caching '{error_class}' error for {ttl}s ({key})")
+        with self._lock:
+            self._entries[key] = (monotonic() + ttl, message)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+
+negative_cache = NegativeCache(config.negative_cache_size, config.negative_cache_ttls_s)
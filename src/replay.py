@@ -0,0 +1,164 @@
+"""
+Replays traffic recorded with TRAFFIC_CAPTURE_FILE into the bot's dispatcher.
+
+Telegram is replaced by a local stand-in of the Bot API. With `--media-file`
+every URL is rewritten to a local HTTP server that serves this file, so no
+media site is contacted either.
+
+    python src/replay.py capture.jsonl --speed 2 --media-file sample.mp4
+"""
+from argparse import ArgumentParser
+from functools import partial
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler, SimpleHTTPRequestHandler
+from itertools import count
+from pathlib import Path
+from threading import Thread
+from time import monotonic, sleep, time
+from typing import Any, Callable, Dict, Optional
+import hashlib
+import json
+import logging
+import re
+
+from bot import InlineBot
+from traffic import load_traffic, map_message_text
+
+
+REPLAY_TOKEN = "123456:REPLAY"
+_URL_PATTERN = re.compile(r"https?://\S+")
+
+
+class FakeBotApiHandler(BaseHTTPRequestHandler):
+    """Answers every Bot API method with a plausible result"""
+    _message_ids = count(1)
+
+    def do_POST(self):
+        method = self.path.rsplit("/", 1)[-1]
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+        try:
+            params = json.loads(body)
+        except ValueError:
+            # multipart upload, the content isn't relevant for us
+            params = {}
+
+        payload = json.dumps({"ok": True, "result": self._result(method, params)}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def _result(self, method: str, params: Dict[str, Any]) -> Any:
+        if method == "getMe":
+            return {"id": 123456, "is_bot": True, "first_name": "Replay", "username": "replay_bot"}
+
+        if method not in ["sendMessage", "sendVideo", "editMessageText"]:
+            return True
+
+        message_id = next(self._message_ids)
+        message = {
+            "message_id": message_id, "date": int(time()), "text": params.get("text", ""),
+            "chat": {"id": self._chat_id(params), "type": "private"}
+        }
+        if method == "sendVideo":
+            message["video"] = {
+                "file_id": f"replay-{message_id}", "file_unique_id": f"replay-{message_id}",
+                "width": 0, "height": 0, "duration": 0
+            }
+        return message
+
+    @staticmethod
+    def _chat_id(params: Dict[str, Any]) -> int:
+        try:
+            return int(params.get("chat_id", 0))
+        except ValueError:
+            return 0
+
+    def log_message(self, format, *args):
+        logging.debug(f"Fake Bot API: {format % args}")
+
+
+class MediaFileHandler(SimpleHTTPRequestHandler):
+    """Serves the same media file for every path"""
+    def __init__(self, *args, media_file: Path, **kwargs):
+        self.media_file = media_file
+        super().__init__(*args, directory=str(media_file.parent), **kwargs)
+
+    def translate_path(self, path):
+        return str(self.media_file)
+
+    def log_message(self, format, *args):
+        logging.debug(f"Media server: {format % args}")
+
+
+def _serve(handler) -> ThreadingHTTPServer:
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def _build_url_mapper(media_file: Optional[Path]) -> Callable[[str], str]:
+    if media_file is None:
+        return str
+
+    server = _serve(partial(MediaFileHandler, media_file=media_file.resolve()))
+    base = f"http://127.0.0.1:{server.server_port}"
+
+    def mapper(url: str) -> str:
+        # keep distinct URLs distinct, as caches are keyed by them
+        key = hashlib.sha1(url.encode()).hexdigest()[:16]
+        return f"{base}/{key}{media_file.suffix}"
+
+    return mapper
+
+
+def _rewrite_urls(update: Dict[str, Any], url_mapper: Callable[[str], str]):
+    if "inline_query" in update:
+        query = update["inline_query"]
+        query["query"] = _URL_PATTERN.sub(lambda m: url_mapper(m.group(0)), query["query"])
+    if "message" in update:
+        map_message_text(update["message"], url_mapper)
+
+
+def replay(capture_file: Path, speed: float, media_file: Optional[Path], drain_s: float):
+    api = _serve(FakeBotApiHandler)
+    url_mapper = _build_url_mapper(media_file)
+
+    bot = InlineBot(
+        REPLAY_TOKEN, base_url=f"http://127.0.0.1:{api.server_port}/bot"
+    )
+    bot.launch(polling=False)
+
+    start = monotonic()
+    replayed = 0
+    try:
+        for offset, update in load_traffic(capture_file):
+            delay = offset / speed - (monotonic() - start)
+            if delay > 0:
+                sleep(delay)
+
+            _rewrite_urls(update, url_mapper)
+            bot.process_update(update)
+            replayed += 1
+
+        logging.info(f"Replayed {replayed} updates in {monotonic() - start:.1f}s, draining")
+        sleep(drain_s)
+    finally:
+        bot.stop()
+        api.shutdown()
+
+
+def main():
+    parser = ArgumentParser(description="Replay recorded updates against local stand-ins")
+    parser.add_argument("capture_file", type=Path)
+    parser.add_argument("--speed", type=float, default=1.0, help="Acceleration of the original timing")
+    parser.add_argument("--media-file", type=Path, help="Serve this file instead of the recorded URLs")
+    parser.add_argument("--drain", type=float, default=30.0, help="Seconds to wait for running requests")
+    args = parser.parse_args()
+
+    replay(args.capture_file, args.speed, args.media_file, args.drain)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,6 @@
 from pydantic import BaseSettings
 from pathlib import Path
+from typing import Dict, Optional
 import logging
 
 
@@ -15,11 +16,47 @@ class Settings(BaseSettings):
 
     logging_mode: str = "INFO"
     dev_null_chat: int = -1
+    bot_api_base_url: str = "https://api.telegram.org/bot"
+    # threads for the download and inline handlers
+    bot_workers: int = 4
+    # keep-alive connections for Bot API calls forwarded from inline children,
+    # on top of one per worker, the polling and the dispatcher thread
+    inline_api_connections: int = 8
+    # uploads of inline children in flight, leaves the rest of their connections to answers
+    inline_uploads: int = 4
+    # calls fail with a NetworkError if no connection is free after this
+    bot_api_pool_timeout_s: float = "10"
 
     debug_yt_traffic: bool = "False"
     yt_socket_timeout: float = "2"
     yt_quiet_mode: bool = "True"
 
+    # failed downloads are answered from cache, TTL per error class
+    negative_cache_size: int = 1024
+    negative_cache_ttls_s: Dict[str, float] = {
+        "network": 15, "other": 60, "private": 600,
+        "is_live": 600, "too_long": 3600, "unsupported": 3600
+    }
+
+    # JSON lines with one span per request phase, disabled if unset
+    trace_file: Optional[Path] = None
+    # fraction of requests that get profiled with cProfile
+    profile_sample_rate: float = "0"
+    profile_path: Path = "./profiles"
+    # file_ids of uploaded files by content, to skip uploading duplicates
+    upload_index_size: int = 4096
+
+    # partial files of cancelled downloads are kept here to resume, disabled if unset
+    staging_path: Optional[Path] = None
+    staging_ttl_s: float = "120"
+    # working directories of downloads without progress for this long are removed
+    staging_orphan_ttl_s: float = "3600"
+    # how long a new inline query waits for the cancelled one to stage its files
+    staging_handover_timeout_s: float = "1"
+
+    # anonymized JSON lines of all incoming updates, disabled if unset
+    traffic_capture_file: Optional[Path] = None
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
 
@@ -0,0 +1,112 @@
+from pathlib import Path
+from time import time
+from typing import Optional
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+
+from settings import config
+from url_cleaner import get_canonical_url
+
+
+class StagingArea:
+    """
+    Keeps the partial files of interrupted downloads for a short time, so that
+    a new download of the same URL can continue from them. Downloads work in
+    temporary directories below `root`, so stashing and claiming are renames.
+    """
+    STASH_PREFIX = "stash-"
+    WORK_PREFIX = "dl-"
+
+    def __init__(self, root: Optional[Path], ttl_s: float, orphan_ttl_s: float):
+        self.root = root
+        self.ttl_s = ttl_s
+        self.orphan_ttl_s = orphan_ttl_s
+
+    @property
+    def enabled(self) -> bool:
+        return self.root is not None
+
+    def temp_dir(self) -> tempfile.TemporaryDirectory:
+        self.root.mkdir(parents=True, exist_ok=True)
+        # the owner pid tells whether a working directory is still in use
+        return tempfile.TemporaryDirectory(prefix=f"{self.WORK_PREFIX}{os.getpid()}-", dir=self.root)
+
+    def _stash_path(self, url: str) -> Path:
+        key = hashlib.sha1(get_canonical_url(url).encode()).hexdigest()
+        return self.root / f"{self.STASH_PREFIX}{key}"
+
+    def claim(self, url: str, target: Path) -> bool:
+        """Move the stash for the URL to `target`. Returns False if there is none"""
+        self.purge()
+        try:
+            # atomic, so only one download can claim a stash
+            os.rename(self._stash_path(url), target)
+        except OSError:
+            return False
+
+        logging.debug(f"Claimed staged download for {url}")
+        return True
+
+    def stash(self, url: str, source: Path) -> bool:
+        """Keep the files in `source` for the URL. Returns False if it's already stashed"""
+        stash_path = self._stash_path(url)
+        try:
+            os.rename(source, stash_path)
+            # the TTL starts now, not with the first file
+            os.utime(stash_path)
+        except OSError:
+            return False
+
+        logging.debug(f"Staged interrupted download for {url}")
+        return True
+
+    def purge(self):
+        """Remove stashes older than the TTL and working directories of killed downloads"""
+        deadline = time() - self.ttl_s
+        for path in self.root.glob(f"{self.STASH_PREFIX}*"):
+            try:
+                if path.stat().st_mtime < deadline:
+                    shutil.rmtree(path)
+            except OSError:
+                # claimed or purged concurrently
+                ...
+
+        for path in self.root.glob(f"{self.WORK_PREFIX}*"):
+            try:
+                if self._is_orphaned(path):
+                    logging.debug(f"Removing orphaned download directory {path}")
+                    shutil.rmtree(path)
+            except OSError:
+                # finished and cleaned up concurrently
+                ...
+
+    def _is_orphaned(self, path: Path) -> bool:
+        """
+        The owner is gone, or nothing was written for `orphan_ttl_s`. The latter
+        covers reused pids, e.g. pid 1 after a container restart
+        """
+        pid = path.name[len(self.WORK_PREFIX):].split("-", 1)[0]
+        if pid.isdigit() and not self._is_alive(int(pid)):
+            return True
+
+        # only the files below change their mtime while downloading
+        newest = max(p.stat().st_mtime for p in [path, *path.rglob("*")])
+        return newest < time() - self.orphan_ttl_s
+
+    @staticmethod
+    def _is_alive(pid: int) -> bool:
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            ...
+        return True
+
+
+staging_area = StagingArea(
+    config.staging_path, config.staging_ttl_s, config.staging_orphan_ttl_s
+)
@@ -0,0 +1,106 @@
+from contextlib import contextmanager
+from dataclasses import dataclass, field, asdict
+from pathlib import Path
+from random import random
+from time import time
+from typing import Any, Dict, Iterator, Optional
+import cProfile
+import json
+import logging
+import os
+
+from settings import config
+from util import generate_token
+
+
+def new_request_id() -> str:
+    return generate_token(6)
+
+
+@dataclass
+class Span:
+    request_id: str
+    name: str
+    start: float = field(default_factory=time)
+    end: Optional[float] = None
+    bytes: Optional[int] = None
+    outcome: str = "ok"
+    pid: int = field(default_factory=os.getpid)
+
+    @property
+    def duration_s(self) -> Optional[float]:
+        if self.end is None:
+            return None
+        return self.end - self.start
+
+
+class Tracer:
+    def __init__(self, trace_file: Optional[Path] = None, profile_path: Optional[Path] = None):
+        self.trace_file = trace_file
+        self.profile_path = profile_path
+
+    @property
+    def enabled(self) -> bool:
+        return self.trace_file is not None
+
+    def write(self, record: Dict[str, Any]):
+        """
+        Append one JSON line to the trace file. Uses a single O_APPEND write,
+        so that the main process and the inline children can share the file
+        without a lock (which wouldn't survive a fork anyway)
+        """
+        if not self.enabled:
+            return
+
+        line = (json.dumps(record) + "\n").encode("utf-8")
+        try:
+            fd = os.open(self.trace_file, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                os.write(fd, line)
+            finally:
+                os.close(fd)
+        except OSError as err:
+            logging.warning(f"Could not write trace record: {err}")
+
+    def write_span(self, span: Span):
+        self.write({"kind": "span", **asdict(span), "duration_s": span.duration_s})
+
+    @contextmanager
+    def span(self, request_id: str, name: str, **kwargs) -> Iterator[Span]:
+        """Measure the enclosed block. The outcome is the exception name if one escapes"""
+        span = Span(request_id, name, **kwargs)
+        try:
+            yield span
+        except BaseException as err:
+            span.outcome = type(err).__name__
+            raise
+        finally:
+            span.end = time()
+            self.write_span(span)
+
+    @contextmanager
+    def profile(self, request_id: str, name: str) -> Iterator[None]:
+        """Run cProfile for a `profile_sample_rate` fraction of requests and dump the stats"""
+        if self.profile_path is None or random() >= config.profile_sample_rate:
+            yield
+            return
+
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            self._dump_profile(profiler, request_id, name)
+
+    def _dump_profile(self, profiler: cProfile.Profile, request_id: str, name: str):
+        try:
+            self.profile_path.mkdir(parents=True, exist_ok=True)
+            path = self.profile_path / f"{name}-{request_id}-{os.getpid()}.prof"
+            profiler.dump_stats(path)
+            logging.debug(f"[{request_id}] Wrote profile to '{path}'")
+        except OSError as err:
+            logging.warning(f"[{request_id}] Could not write profile: {err}")
+
+
+tracer = Tracer(config.trace_file, config.profile_path)
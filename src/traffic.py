@@ -0,0 +1,131 @@
+from pathlib import Path
+from time import time
+from typing import Any, Callable, Dict, Iterator, Tuple
+import hashlib
+import json
+import logging
+import os
+import secrets
+
+from telegram import Update
+
+
+# only these fields of an update are recorded, everything else is dropped
+_KEPT_FIELDS = {
+    "inline_query": ["id", "from", "query", "offset", "chat_type"],
+    "message": [
+        "message_id", "date", "chat", "from", "forward_from", "forward_date", "text", "entities"
+    ],
+}
+_KEPT_FIELDS["edited_message"] = _KEPT_FIELDS["message"]
+# user and chat objects are replaced by pseudonyms
+_USER_KEYS = ["from", "forward_from"]
+_CHAT_KEYS = ["chat"]
+# only these entities of a message text are kept, the rest of the text is dropped
+_KEPT_ENTITY_TYPES = ["url", "bot_command"]
+
+
+def map_message_text(message: Dict[str, Any], url_mapper: Callable[[str], str] = str):
+    """
+    Reduce the text of a message dict to its URLs and bot commands and
+    rebuild the entities to match. URLs are passed through `url_mapper`.
+    """
+    text = message.get("text")
+    if text is None:
+        return
+
+    parts, entities, offset = [], [], 0
+    for entity in sorted(message.get("entities", []), key=lambda e: e["offset"]):
+        if entity["type"] not in _KEPT_ENTITY_TYPES:
+            continue
+
+        part = text[entity["offset"]:entity["offset"] + entity["length"]]
+        if entity["type"] == "url":
+            part = url_mapper(part)
+
+        entities.append({**entity, "offset": offset, "length": len(part)})
+        parts.append(part)
+        offset += len(part) + 1
+
+    message["text"] = " ".join(parts)
+    message["entities"] = entities
+
+
+class TrafficRecorder:
+    """
+    Appends every incoming update as an anonymized JSON line, together with
+    its arrival time and an id of the recording session, as the bot appends
+    to the same file after a restart
+    """
+    def __init__(self, capture_file: Path):
+        self.capture_file = capture_file
+        self._salt = secrets.token_bytes(16)
+        self._session = secrets.token_hex(8)
+
+    def record(self, update: Update):
+        record = {
+            "session": self._session,
+            "t": time(),
+            "update": self.anonymize(update.to_dict())
+        }
+        line = (json.dumps(record) + "\n").encode("utf-8")
+
+        try:
+            fd = os.open(self.capture_file, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+            try:
+                os.write(fd, line)
+            finally:
+                os.close(fd)
+        except OSError as err:
+            logging.warning(f"Could not record update: {err}")
+
+    def anonymize(self, update: Dict[str, Any]) -> Dict[str, Any]:
+        """Keep only the fields the replay needs, users and chats become pseudonyms"""
+        result = {"update_id": update["update_id"]}
+        for kind, fields in _KEPT_FIELDS.items():
+            if kind not in update:
+                continue
+
+            data = {}
+            for key in fields:
+                value = update[kind].get(key)
+                if value is None:
+                    continue
+                elif key in _USER_KEYS:
+                    value = {
+                        "id": self._pseudonym(value["id"]),
+                        "is_bot": value.get("is_bot", False),
+                        "first_name": "user"
+                    }
+                elif key in _CHAT_KEYS:
+                    value = {"id": self._pseudonym(value["id"]), "type": value["type"]}
+                data[key] = value
+
+            map_message_text(data)
+            result[kind] = data
+        return result
+
+    def _pseudonym(self, uid: int) -> int:
+        """Stable within a recording, so that keystrokes of a user stay grouped"""
+        digest = hashlib.sha256(self._salt + str(abs(uid)).encode()).hexdigest()
+        pseudonym = int(digest[:12], 16)
+        return -pseudonym if uid < 0 else pseudonym
+
+
+def load_traffic(capture_file: Path) -> Iterator[Tuple[float, Dict[str, Any]]]:
+    """
+    Yields (offset in s, update dict) for every recorded update. Every
+    session starts at its first update, directly after the previous one
+    """
+    session, session_start, offset = None, None, 0.0
+    with open(capture_file, "r") as f:
+        for line in f:
+            if line.strip() == "":
+                continue
+            record = json.loads(line)
+
+            if session_start is None or record.get("session") != session:
+                session = record.get("session")
+                session_start = record["t"] - offset
+            offset = record["t"] - session_start
+            yield offset, record["update"]
@@ -0,0 +1,135 @@
+from collections import OrderedDict
+from dataclasses import dataclass
+from pathlib import Path
+from threading import Lock, Thread
+from typing import Optional, Tuple
+import hashlib
+import logging
+import os
+
+from telegram import TelegramError
+
+from settings import config
+from tracing import tracer
+
+
+SAMPLE_SIZE = 64 * 1024
+SAMPLE_COUNT = 4
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def fingerprint(path: Path) -> str:
+    """Cheap prefilter: the file size and a few evenly spaced chunks"""
+    size = path.stat().st_size
+    digest = hashlib.sha1()
+
+    with open(path, "rb") as f:
+        step = max(size - SAMPLE_SIZE, 0) // (SAMPLE_COUNT - 1)
+        for i in range(SAMPLE_COUNT):
+            f.seek(i * step)
+            digest.update(f.read(SAMPLE_SIZE))
+
+    return f"{size}:{digest.hexdigest()}"
+
+
+def content_hash(path: Path) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(HASH_CHUNK_SIZE):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def is_file_id_error(err: TelegramError) -> bool:
+    """Whether Telegram rejected a file_id, e.g. "Wrong file identifier/http url specified" """
+    message = err.message.lower()
+    return any(m in message for m in ["file identifier", "file_id", "file reference"])
+
+
+@dataclass
+class UploadEntry:
+    content_hash: str
+    file_id: str
+    size: int
+
+
+class PendingEntry(Thread):
+    """Hashes a file in the background while it is uploaded"""
+    def __init__(self, path: Path):
+        super().__init__(daemon=True)
+        self.path = path
+        self._result: Optional[Tuple[str, str, int]] = None
+        self.start()
+
+    def run(self):
+        try:
+            self._result = fingerprint(self.path), content_hash(self.path), self.path.stat().st_size
+        except OSError as err:
+            # the download was cleaned up in the meantime
+            logging.debug(f"Could not hash {self.path}: {err}")
+
+    def entry(self, file_id: str) -> Optional[Tuple[str, UploadEntry]]:
+        """The (fingerprint, entry) pair for the index, once the hash is done"""
+        self.join()
+        if self._result is None:
+            return None
+        key, digest, size = self._result
+        return key, UploadEntry(digest, file_id, size)
+
+
+class UploadIndex:
+    """
+    Maps already uploaded files onto their Telegram file_id, so that the same
+    media reached through different URLs is only uploaded once
+    """
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.bytes_saved = 0
+
+        self._lock = Lock()
+        self._entries: "OrderedDict[str, UploadEntry]" = OrderedDict()
+        # inline children use their forked copy, the lock might have been held during the fork
+        os.register_at_fork(after_in_child=self._reset_lock)
+
+    def _reset_lock(self):
+        self._lock = Lock()
+
+    def get(self, path: Path) -> Optional[UploadEntry]:
+        """Find an upload with the same content. Only hashes the file on a prefilter match"""
+        key = fingerprint(path)
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is None or entry.content_hash != content_hash(path):
+            return None
+
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+        return entry
+
+    def put(self, key: str, entry: UploadEntry):
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def remove(self, file_id: str):
+        """Forget a file_id that Telegram doesn't accept anymore"""
+        with self._lock:
+            for key in [k for k, e in self._entries.items() if e.file_id == file_id]:
+                del self._entries[key]
+
+    def add_saved(self, size: int):
+        with self._lock:
+            self.bytes_saved += size
+
+    def record_saved(self, request_id: str, size: int):
+        self.add_saved(size)
+        tracer.write({
+            "kind": "metric", "name": "upload_bytes_saved", "value": size, "request_id": request_id
+        })
+        logging.info(f"[{request_id}] Reused earlier upload, saved {size} bytes")
+
+
+upload_index = UploadIndex(config.upload_index_size)
@@ -24,3 +24,8 @@ def get_cleaned_url(url: str, info: Dict[str, Any]) -> str:
             return urlunsplit(p)
 
     return url
+
+
+def get_canonical_url(url: str) -> str:
+    """Cleaned URL without extraction info, usable as a cache key before the download"""
+    return get_cleaned_url(url.strip(), {})